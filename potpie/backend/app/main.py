@@ -1,15 +1,34 @@
-import os
-from typing import Dict, List, Optional
+import asyncio
+import hashlib
+import json
+import pathlib
+import re
+import sys
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, suppress
+from functools import lru_cache
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple, Union
 
 import httpx
-from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+import orjson
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from loguru import logger
-from pydantic import BaseModel, Field, ValidationError
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
 from pydantic_ai import Agent
+from pydantic_ai.exceptions import ModelHTTPError, UnexpectedModelBehavior
+from pydantic_ai.messages import SystemPromptPart
 from pydantic_ai.models.openai import OpenAIChatModel
 from pydantic_ai.providers.openrouter import OpenRouterProvider
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 
 class FailureRequest(BaseModel):
@@ -30,37 +49,341 @@ class FailureAnalysis(BaseModel):
     long_term_warning: str
 
 
-import pathlib
+class BatchItemError(BaseModel):
+    error: str
+    status_code: int
+
+
+# Built once; the streaming path serializes partial results through it
+_ANALYSIS_ADAPTER = TypeAdapter(FailureAnalysis)
+
 
 backend_dir = pathlib.Path(__file__).parent.parent
 env_path = backend_dir / ".env"
-load_dotenv(dotenv_path=env_path)
-
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
-MODEL_NAME = os.getenv("OPENROUTER_MODEL", "mistralai/mixtral-8x7b-instruct")
-
-def build_agent() -> Agent[FailureAnalysis]:
-    api_key = OPENROUTER_API_KEY if OPENROUTER_API_KEY and OPENROUTER_API_KEY != "your_key_here" else None
-    provider = OpenRouterProvider(api_key=api_key)
-    model = OpenAIChatModel(model_name=MODEL_NAME, provider=provider)
-    system_prompt = (
-        "You are 'Explain My Failure' — a brutally honest analyst. "
-        "Return concise, specific critiques. Avoid generic coaching. "
-        "Use the user's context to surface patterns and actionable fixes."
+
+
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=str(env_path), extra="ignore")
+
+    openrouter_api_key: str = ""
+    openrouter_model: str = "mistralai/mixtral-8x7b-instruct"
+    cache_ttl_seconds: float = 1800
+    cache_max_entries: int = 1024
+    semantic_cache: bool = False
+    semantic_cache_threshold: float = 0.95
+    max_concurrency: int = 32
+    max_batch_items: int = 100
+    prompt_cache_control: bool = True
+    # Off by default: batching mixes different users' descriptions into one prompt
+    micro_batch_window_ms: float = 0
+    micro_batch_max_size: int = 8
+    # Comma-separated list of frontend origins allowed to call the API
+    cors_origins: str = "http://localhost:4173,http://127.0.0.1:4173"
+    warmup_on_startup: bool = True
+    retry_attempts: int = 4
+    keepalive_interval_seconds: float = 30
+    demo_rate_limit: str = "60/minute"
+    log_level: str = "INFO"
+    log_json: bool = False
+
+
+SETTINGS = Settings()
+
+# enqueue=True hands records to a background thread so sinks never block the event loop
+logger.remove()
+logger.add(sys.stderr, level=SETTINGS.log_level, serialize=SETTINGS.log_json, enqueue=True)
+# Demo mode if API key is missing; decided once at startup
+USE_DEMO = not SETTINGS.openrouter_api_key or SETTINGS.openrouter_api_key == "your_key_here"
+MODEL_NAME = SETTINGS.openrouter_model
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Everything here is sent verbatim before any per-request data so that provider
+# prompt caches can reuse it. Do not interpolate request values into it.
+SYSTEM_PROMPT = """\
+You are 'Explain My Failure' — a brutally honest analyst.
+Return concise, specific critiques. Avoid generic coaching.
+Use the user's context to surface patterns and actionable fixes.
+
+Rubric:
+- Name the single mechanism that most directly caused the failure. Prefer a behaviour the user controlled over luck or circumstance.
+- Secondary causes are contributing factors, not restatements of the primary cause.
+- A behaviour pattern is a repeated loop written as steps joined with arrows, e.g. "A → B → C → Failure".
+- False beliefs are assumptions the user acted on that turned out to be wrong. Use the reported effort, preparation hours and confidence when they reveal a miscalibration.
+- The harsh truth is one or two sentences the user would rather not hear. Be direct, never insulting.
+- Corrective actions are concrete and checkable; each starts with a verb.
+- The recovery plan has exactly seven keys, "Day 1" through "Day 7", each with one specific task.
+- The long-term warning describes what happens if nothing changes.
+
+Output fields:
+- primary_root_cause: string
+- secondary_causes: list of 2-4 strings
+- repeated_behavior_pattern: string
+- false_beliefs_or_assumptions: list of 2-4 strings
+- harsh_truth: string
+- corrective_actions: list of 3-6 strings
+- seven_day_recovery_plan: object mapping "Day 1".."Day 7" to strings
+- long_term_warning: string
+
+Example input:
+Failure description: I failed my driving test after practising only on quiet roads near home.
+Effort level: 6
+Preparation hours: 10
+Confidence before: 8
+
+Example output:
+{"primary_root_cause": "You practised in conditions that never resembled the test route.",
+ "secondary_causes": ["No mock test with an examiner-style observer", "Avoided roundabouts and busy junctions"],
+ "repeated_behavior_pattern": "Practise what feels easy → Mistake comfort for competence → Get exposed under pressure → Failure",
+ "false_beliefs_or_assumptions": ["10 hours on familiar roads transfers to any road", "Confidence 8/10 meant readiness"],
+ "harsh_truth": "You rehearsed for a test that doesn't exist.",
+ "corrective_actions": ["Drive the actual test routes three times a week", "Book two mock tests with an instructor", "Log every mistake and repeat that manoeuvre until clean"],
+ "seven_day_recovery_plan": {"Day 1": "List every fault from the test sheet", "Day 2": "Drive the test route with an instructor", "Day 3": "Practise the two weakest manoeuvres", "Day 4": "Drive in rush-hour traffic", "Day 5": "Take a full mock test", "Day 6": "Fix faults from the mock", "Day 7": "Book the retest"},
+ "long_term_warning": "If you keep practising only what is comfortable, every future assessment will expose the same gap."}
+
+The failure details follow. Provide a concise, structured diagnosis for each failure.
+"""
+SYSTEM_PROMPT_DIGEST = hashlib.blake2b(SYSTEM_PROMPT.encode(), digest_size=8).hexdigest()
+
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+_last_provider_request = 0.0
+
+
+async def _mark_provider_request(request: httpx.Request) -> None:
+    global _last_provider_request
+    _last_provider_request = time.monotonic()
+
+
+# One pooled client for every provider call, so TLS sessions are reused
+SHARED_HTTPX = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=256, max_keepalive_connections=64, keepalive_expiry=120),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    event_hooks={"request": [_mark_provider_request]},
+)
+
+
+def build_model() -> OpenAIChatModel:
+    # The model is never called in demo mode, but the provider refuses an empty key
+    api_key = "demo" if USE_DEMO else SETTINGS.openrouter_api_key
+    # run_agent owns retries; the SDK's own retries would multiply every attempt
+    client = AsyncOpenAI(base_url=OPENROUTER_BASE_URL, api_key=api_key, http_client=SHARED_HTTPX, max_retries=0)
+    provider = OpenRouterProvider(openai_client=client)
+    return OpenAIChatModel(model_name=MODEL_NAME, provider=provider)
+
+
+def build_agent(model: OpenAIChatModel, output_type=FailureAnalysis) -> Agent:
+    # OpenRouter applies the breakpoint to the stable prefix for providers that
+    # need explicit cache markers (Anthropic); others cache prefixes automatically.
+    model_settings = {"extra_body": {"cache_control": {"type": "ephemeral"}}} if SETTINGS.prompt_cache_control else None
+    return Agent(
+        model=model,
+        output_type=output_type,
+        system_prompt=SYSTEM_PROMPT,
+        model_settings=model_settings,
+        retries=2,
+    )
+
+
+def _cached_token_ratio(result) -> str:
+    usage = result.usage()
+    cached = getattr(usage, "cache_read_tokens", 0) or 0
+    total = getattr(usage, "input_tokens", None) or getattr(usage, "request_tokens", 0) or 0
+    return f"{cached}/{total}"
+
+
+def _sent_prefix_digest(result) -> str:
+    # Hash the system parts of the first request actually sent, not the constant
+    messages = result.all_messages()
+    parts = messages[0].parts if messages else ()
+    prefix = "".join(part.content for part in parts if isinstance(part, SystemPromptPart))
+    return hashlib.blake2b(prefix.encode(), digest_size=8).hexdigest()
+
+
+def log_prompt_cache_usage(result) -> None:
+    digest = _sent_prefix_digest(result)
+    if digest != SYSTEM_PROMPT_DIGEST:
+        logger.warning("Prompt prefix drifted: sent {}, expected {}", digest, SYSTEM_PROMPT_DIGEST)
+    logger.opt(lazy=True).debug(
+        "Prompt prefix {}: {} input tokens served from cache",
+        lambda: digest,
+        lambda: _cached_token_ratio(result),
     )
-    return Agent(model=model, output_type=FailureAnalysis, system_prompt=system_prompt, retries=2)
 
 
-agent = build_agent()
-app = FastAPI(title="Explain My Failure API", version="0.1.0")
+chat_model = build_model()
+agent = build_agent(chat_model)
+# Same system prompt as `agent`, so micro-batched calls share its cached prefix
+batch_agent = build_agent(chat_model, output_type=List[FailureAnalysis])
+
+
+# Response cache: exact-match on the full request, plus an optional semantic
+# layer that reuses answers for near-identical descriptions.
+_response_cache: "OrderedDict[str, Tuple[float, FailureAnalysis]]" = OrderedDict()
+_semantic_index: Deque[Tuple[object, str, str]] = deque(maxlen=SETTINGS.cache_max_entries)
+_cache_lock = asyncio.Lock()
+_embedder = None
+
+
+def _cache_key(payload: FailureRequest) -> str:
+    raw = json.dumps({"model": MODEL_NAME, **payload.model_dump()}, sort_keys=True)
+    return hashlib.blake2b(raw.encode()).hexdigest()
+
+
+def _context_key(payload: FailureRequest) -> str:
+    # Semantic matches only apply when everything except the wording agrees
+    return f"{MODEL_NAME}|{payload.effort_level}|{payload.preparation_hours}|{payload.confidence_before}"
+
+
+def load_embedder() -> None:
+    # Called once at startup; the semantic layer stays off unless this succeeds
+    global _embedder
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError:
+        logger.warning("SEMANTIC_CACHE is set but sentence-transformers is not installed; using exact-match caching only")
+        return
+    _embedder = SentenceTransformer(EMBEDDING_MODEL)
+    logger.info("Semantic cache enabled with {}", EMBEDDING_MODEL)
+
+
+def _embed(text: str):
+    return _embedder.encode(text, normalize_embeddings=True)
+
+
+def _cache_lookup(key: str) -> Optional[FailureAnalysis]:
+    entry = _response_cache.get(key)
+    if entry is None:
+        return None
+    stored_at, analysis = entry
+    if time.monotonic() - stored_at >= SETTINGS.cache_ttl_seconds:
+        del _response_cache[key]
+        return None
+    _response_cache.move_to_end(key)
+    return analysis
+
+
+async def _run_cached(payload: FailureRequest, run: Callable[[], Awaitable[FailureAnalysis]]) -> FailureAnalysis:
+    key = _cache_key(payload)
+    async with _cache_lock:
+        cached = _cache_lookup(key)
+    if cached is not None:
+        logger.debug("Response cache hit (exact)")
+        return cached
+
+    embedding = None
+    if _embedder is not None:
+        embedding = await asyncio.to_thread(_embed, payload.description)
+        context = _context_key(payload)
+        async with _cache_lock:
+            best_key, best_score = None, 0.0
+            for other, other_context, other_key in _semantic_index:
+                if other_context != context:
+                    continue
+                score = float(embedding @ other)
+                if score > best_score:
+                    best_key, best_score = other_key, score
+            cached = _cache_lookup(best_key) if best_score > SETTINGS.semantic_cache_threshold else None
+        if cached is not None:
+            logger.debug("Response cache hit (semantic, similarity={:.3f})", best_score)
+            return cached
+
+    analysis = await run()
+    await _cache_store(payload, key, analysis, embedding)
+    return analysis
+
+
+async def _cache_store(payload: FailureRequest, key: str, analysis: FailureAnalysis, embedding=None) -> None:
+    async with _cache_lock:
+        _response_cache[key] = (time.monotonic(), analysis)
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > SETTINGS.cache_max_entries:
+            _response_cache.popitem(last=False)
+        if embedding is not None:
+            _semantic_index.append((embedding, _context_key(payload), key))
+
+
+async def warm_up_agent() -> None:
+    # Opens the pooled connection before the first real request. A plain-text
+    # agent with no retries makes exactly one short call that can succeed;
+    # the FailureAnalysis schema is already built when `agent` is constructed.
+    warmup_agent = Agent(chat_model, output_type=str, retries=0)
+    try:
+        await asyncio.wait_for(
+            warmup_agent.run("Reply with OK.", model_settings={"max_tokens": 4}),
+            timeout=10,
+        )
+    except Exception as exc:
+        logger.warning("Warmup failed: {}", exc)
+        return
+    logger.info("Agent warmed up")
+
+
+async def keep_provider_connection_warm(interval: float) -> None:
+    # The provider's load balancer drops idle connections after about a minute;
+    # a small authenticated request during quiet periods keeps one pooled socket open
+    while True:
+        # Wake exactly one interval after the latest provider request
+        await asyncio.sleep(max(0.0, _last_provider_request + interval - time.monotonic()))
+        if time.monotonic() - _last_provider_request < interval:
+            continue
+        try:
+            await SHARED_HTTPX.get(
+                f"{OPENROUTER_BASE_URL}/key",
+                headers={"Authorization": f"Bearer {SETTINGS.openrouter_api_key}"},
+                timeout=5,
+            )
+        except Exception as exc:
+            logger.debug("Keepalive ping failed: {}", exc)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    keepalive_task = None
+    if USE_DEMO:
+        prewarm_demo_cache()
+    else:
+        if SETTINGS.semantic_cache:
+            await asyncio.to_thread(load_embedder)
+        if SETTINGS.micro_batch_window_ms > 0:
+            batcher.start()
+        if SETTINGS.warmup_on_startup:
+            await warm_up_agent()
+        if SETTINGS.keepalive_interval_seconds > 0:
+            keepalive_task = asyncio.create_task(keep_provider_connection_warm(SETTINGS.keepalive_interval_seconds))
+    yield
+    if keepalive_task is not None:
+        keepalive_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await keepalive_task
+    await batcher.stop()
+    await SHARED_HTTPX.aclose()
+
+
+app = FastAPI(
+    title="Explain My Failure API",
+    version="0.1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
+# Only demo mode is limited, so bots can't monopolize a keyless deployment.
+# Behind a load balancer, run uvicorn with --proxy-headers --forwarded-allow-ips
+# so the client address is the visitor's, not the proxy's.
+limiter = Limiter(key_func=get_remote_address)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=[origin.strip() for origin in SETTINGS.cors_origins.split(",") if origin.strip()],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Authorization"],
+    # Let browsers reuse preflight responses for a day
+    max_age=86400,
 )
+# Analyses are a few KB of repetitive prose; small bodies like /health stay uncompressed
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=5)
 
 
 @app.get("/health") 
@@ -68,110 +391,464 @@ async def health():
     return {"status": "ok"}
 
 
-def generate_demo_response(description: str, effort: int, prep_hours: int, confidence: int) -> FailureAnalysis:
-    desc_lower = description.lower()
-    is_exam = any(word in desc_lower for word in ["exam", "test", "quiz", "exam"])
-    is_interview = any(word in desc_lower for word in ["interview", "interviewed", "interviewing"])
-    is_project = any(word in desc_lower for word in ["project", "assignment", "deadline"])
-    
-    if is_exam:
-        root_cause = "Passive learning without active recall. You consumed content but didn't test your understanding under pressure."
-        pattern = "Cramming → False confidence → Performance anxiety → Failure"
-        truth = "Watching videos isn't studying. You need to solve problems yourself, time yourself, and fail in practice before the real test."
-    elif is_interview:
-        root_cause = "Insufficient mock practice and overconfidence from solving problems in isolation."
-        pattern = "LeetCode in comfort → Avoiding system design → No mock interviews → Freezing under pressure"
-        truth = "You prepared for the wrong thing. Interviews test communication and problem-solving under pressure, not just coding ability."
-    elif is_project:
-        root_cause = "Poor planning and underestimating complexity. Started coding before understanding requirements."
-        pattern = "Jumping to code → Scope creep → Deadline pressure → Rushed work → Failure"
-        truth = "You confused activity with progress. Planning and breaking down problems saves more time than it costs."
-    else:
-        root_cause = "Gap between perceived effort and actual effective work. You did things that felt productive but didn't address core weaknesses."
-        pattern = "Surface-level preparation → Avoiding difficult practice → Overconfidence → Reality check → Failure"
-        truth = "Effort without direction is just busywork. You need to identify your weakest points and attack them directly."
-    
-    return FailureAnalysis(
-        primary_root_cause=root_cause,
-        secondary_causes=[
-            "Insufficient practice under realistic conditions",
-            "Avoiding difficult or uncomfortable practice scenarios",
-            "Overestimating readiness based on passive learning"
-        ],
-        repeated_behavior_pattern=pattern,
-        false_beliefs_or_assumptions=[
+# Substring match, like the original keyword scan; group names are the categories
+_CATEGORY_RE = re.compile(
+    r"(?P<exam>exam|test|quiz)|(?P<interview>interview)|(?P<project>project|assignment|deadline)",
+    re.IGNORECASE,
+)
+_CATEGORY_PRIORITY = ("exam", "interview", "project")
+
+_DEMO_CATEGORIES: Dict[str, Dict[str, str]] = {
+    "exam": {
+        "primary_root_cause": "Passive learning without active recall. You consumed content but didn't test your understanding under pressure.",
+        "repeated_behavior_pattern": "Cramming → False confidence → Performance anxiety → Failure",
+        "harsh_truth": "Watching videos isn't studying. You need to solve problems yourself, time yourself, and fail in practice before the real test.",
+    },
+    "interview": {
+        "primary_root_cause": "Insufficient mock practice and overconfidence from solving problems in isolation.",
+        "repeated_behavior_pattern": "LeetCode in comfort → Avoiding system design → No mock interviews → Freezing under pressure",
+        "harsh_truth": "You prepared for the wrong thing. Interviews test communication and problem-solving under pressure, not just coding ability.",
+    },
+    "project": {
+        "primary_root_cause": "Poor planning and underestimating complexity. Started coding before understanding requirements.",
+        "repeated_behavior_pattern": "Jumping to code → Scope creep → Deadline pressure → Rushed work → Failure",
+        "harsh_truth": "You confused activity with progress. Planning and breaking down problems saves more time than it costs.",
+    },
+    "general": {
+        "primary_root_cause": "Gap between perceived effort and actual effective work. You did things that felt productive but didn't address core weaknesses.",
+        "repeated_behavior_pattern": "Surface-level preparation → Avoiding difficult practice → Overconfidence → Reality check → Failure",
+        "harsh_truth": "Effort without direction is just busywork. You need to identify your weakest points and attack them directly.",
+    },
+}
+
+_DEMO_BASE = FailureAnalysis(
+    primary_root_cause="",
+    secondary_causes=[
+        "Insufficient practice under realistic conditions",
+        "Avoiding difficult or uncomfortable practice scenarios",
+        "Overestimating readiness based on passive learning"
+    ],
+    repeated_behavior_pattern="",
+    false_beliefs_or_assumptions=[],
+    harsh_truth="",
+    corrective_actions=[
+        "Identify the 3 weakest areas and practice them daily",
+        "Create realistic practice scenarios that mirror the actual challenge",
+        "Track metrics: time spent, accuracy, consistency",
+        "Get external feedback before the next attempt",
+        "Build a recovery timeline with specific milestones"
+    ],
+    seven_day_recovery_plan={
+        "Day 1": "Honest self-assessment: List exactly what went wrong and why",
+        "Day 2": "Identify 3 core weaknesses and find resources to address them",
+        "Day 3": "Create a structured practice schedule with daily goals",
+        "Day 4": "Start practicing the hardest problems/scenarios first",
+        "Day 5": "Get feedback from someone who succeeded in this area",
+        "Day 6": "Simulate the actual conditions and test yourself",
+        "Day 7": "Review progress, adjust plan, commit to long-term improvement"
+    },
+    long_term_warning="If you don't change your approach fundamentally, you'll repeat this cycle. Stop doing what feels comfortable and start doing what's actually effective."
+)
+
+# Templates share the base lists and dict; treat them as read-only
+_DEMO_TEMPLATES: Dict[str, FailureAnalysis] = {
+    category: _DEMO_BASE.model_copy(update=fields) for category, fields in _DEMO_CATEGORIES.items()
+}
+
+
+def classify_failure(description: str) -> str:
+    found = {match.lastgroup for match in _CATEGORY_RE.finditer(description)}
+    for category in _CATEGORY_PRIORITY:
+        if category in found:
+            return category
+    return "general"
+
+
+@lru_cache(maxsize=4096)
+def _demo_core(category: str, effort: int, prep_hours: int, confidence: int) -> FailureAnalysis:
+    return _DEMO_TEMPLATES[category].model_copy(update={
+        "false_beliefs_or_assumptions": [
             f"Effort level {effort}/10 was sufficient",
             f"{prep_hours} hours of preparation was enough",
             f"Confidence level {confidence}/10 reflected actual ability"
-        ],
-        harsh_truth=truth,
-        corrective_actions=[
-            "Identify the 3 weakest areas and practice them daily",
-            "Create realistic practice scenarios that mirror the actual challenge",
-            "Track metrics: time spent, accuracy, consistency",
-            "Get external feedback before the next attempt",
-            "Build a recovery timeline with specific milestones"
-        ],
-        seven_day_recovery_plan={
-            "Day 1": "Honest self-assessment: List exactly what went wrong and why",
-            "Day 2": "Identify 3 core weaknesses and find resources to address them",
-            "Day 3": "Create a structured practice schedule with daily goals",
-            "Day 4": "Start practicing the hardest problems/scenarios first",
-            "Day 5": "Get feedback from someone who succeeded in this area",
-            "Day 6": "Simulate the actual conditions and test yourself",
-            "Day 7": "Review progress, adjust plan, commit to long-term improvement"
-        },
-        long_term_warning="If you don't change your approach fundamentally, you'll repeat this cycle. Stop doing what feels comfortable and start doing what's actually effective."
+        ]
+    })
+
+
+@lru_cache(maxsize=4096)
+def _demo_json(category: str, effort: int, prep_hours: int, confidence: int) -> bytes:
+    return orjson.dumps(_demo_core(category, effort, prep_hours, confidence).model_dump())
+
+
+def generate_demo_response(description: str, effort: int, prep_hours: int, confidence: int) -> FailureAnalysis:
+    # Cached instances are shared between requests; callers must not mutate them
+    return _demo_core(classify_failure(description), effort, prep_hours, confidence)
+
+
+def generate_demo_json(description: str, effort: int, prep_hours: int, confidence: int) -> bytes:
+    return _demo_json(classify_failure(description), effort, prep_hours, confidence)
+
+
+# Common inputs whose demo payloads are serialized before the first request
+_DEMO_EFFORT_LEVELS = (0, 3, 5, 7, 10)
+_DEMO_PREP_HOURS = (0, 5, 20, 100)
+_DEMO_CONFIDENCE_LEVELS = (0, 5, 10)
+
+
+def prewarm_demo_cache() -> None:
+    for category in _DEMO_TEMPLATES:
+        for effort in _DEMO_EFFORT_LEVELS:
+            for prep_hours in _DEMO_PREP_HOURS:
+                for confidence in _DEMO_CONFIDENCE_LEVELS:
+                    _demo_json(category, effort, prep_hours, confidence)
+    logger.info("Demo cache prewarmed with {} payloads", _demo_json.cache_info().currsize)
+
+
+# Only per-request values go here; the instructions live in SYSTEM_PROMPT
+_PROMPT_TMPL = (
+    "Failure description:\n"
+    "{description}\n"
+    "\n"
+    "Effort level: {effort_level}\n"
+    "Preparation hours: {preparation_hours}\n"
+    "Confidence before: {confidence_before}\n"
+)
+_BATCH_HEADER_TMPL = (
+    "Analyze each of the {count} failures below independently; never carry details from one into another. "
+    "Return a list of exactly {count} analyses in the same order.\n\n"
+)
+_BATCH_ITEM_TMPL = "Failure #{index}:\n{prompt}"
+
+
+def render_prompt(payload: FailureRequest) -> str:
+    return _PROMPT_TMPL.format_map({
+        "description": payload.description,
+        "effort_level": payload.effort_level,
+        "preparation_hours": payload.preparation_hours,
+        "confidence_before": payload.confidence_before,
+    })
+
+
+def render_batch_prompt(payloads: List[FailureRequest]) -> str:
+    items = "\n".join(
+        _BATCH_ITEM_TMPL.format_map({"index": i, "prompt": render_prompt(p)}) for i, p in enumerate(payloads, 1)
     )
+    return _BATCH_HEADER_TMPL.format_map({"count": len(payloads)}) + items
+
 
+_TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+_AUTH_STATUS_CODES = {401, 403}
+# Last resort for errors that carry no status code
+_AUTH_ERR_RE = re.compile(r"api_key|authentication|\b401\b", re.IGNORECASE)
 
-@app.post("/analyze", response_model=FailureAnalysis)
-async def analyze_failure(payload: FailureRequest):
-    # Demo mode if API key is missing
-    use_demo = not OPENROUTER_API_KEY or OPENROUTER_API_KEY == "your_key_here"
-    
-    if use_demo:
-        logger.info("Using demo mode - API key not set")
-        return generate_demo_response(
-            payload.description,
-            payload.effort_level or 5,
-            payload.preparation_hours or 0,
-            payload.confidence_before or 5
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    if isinstance(exc, ModelHTTPError):
+        return exc.status_code
+    if isinstance(exc, APIStatusError):
+        return exc.status_code
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code
+    return None
+
+
+def _is_auth_error(exc: BaseException) -> bool:
+    status_code = _status_code(exc)
+    if status_code is not None:
+        return status_code in _AUTH_STATUS_CODES
+    return _AUTH_ERR_RE.search(str(exc)) is not None
+
+
+def _is_connection_error(exc: BaseException) -> bool:
+    # The SDK raises APIConnectionError for connection failures and timeouts;
+    # pydantic-ai re-raises it as a status-less ModelAPIError chained from it
+    return any(
+        isinstance(err, (APIConnectionError, httpx.TransportError)) for err in (exc, exc.__cause__)
+    )
+
+
+def _is_transient(exc: BaseException) -> bool:
+    if _is_connection_error(exc):
+        return True
+    return _status_code(exc) in _TRANSIENT_STATUS_CODES
+
+
+async def run_agent(runner: Agent, prompt: str):
+    # Rate limits and 5xx from the provider are retried with jittered backoff;
+    # anything else (auth, bad request) surfaces immediately
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(SETTINGS.retry_attempts),
+        wait=wait_random_exponential(multiplier=0.5, max=8),
+        retry=retry_if_exception(_is_transient),
+        reraise=True,
+    ):
+        with attempt:
+            result = await runner.run(prompt)
+    return result
+
+
+async def analyze_one(payload: FailureRequest) -> FailureAnalysis:
+    # pydantic-ai v1.x returns an AgentRunResult with validated `.output`
+    result = await run_agent(agent, render_prompt(payload))
+    log_prompt_cache_usage(result)
+    logger.opt(lazy=True).debug("Analysis completed for {}", lambda: payload.description[:40])
+    return result.output
+
+
+async def analyze_many(payloads: List[FailureRequest]) -> List[FailureAnalysis]:
+    result = await run_agent(batch_agent, render_batch_prompt(payloads))
+    log_prompt_cache_usage(result)
+    if len(result.output) != len(payloads):
+        raise UnexpectedModelBehavior(
+            f"Batched call returned {len(result.output)} analyses for {len(payloads)} failures"
         )
+    logger.debug("Analysis completed for a batch of {}", len(payloads))
+    return result.output
 
-    prompt = f"""
-Failure description:
-{payload.description}
 
-Effort level: {payload.effort_level}
-Preparation hours: {payload.preparation_hours}
-Confidence before: {payload.confidence_before}
+def _fail_pending(items: List[Tuple[FailureRequest, asyncio.Future]], exc: BaseException) -> None:
+    for _, future in items:
+        if not future.done():
+            future.set_exception(exc)
 
-Provide a concise, structured diagnosis.
-"""
+
+class MicroBatcher:
+    """Coalesces /analyze calls that arrive within a short window into one model request."""
+
+    def __init__(self, window_ms: float, max_size: int):
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self._queue: Optional["asyncio.Queue[Tuple[FailureRequest, asyncio.Future]]"] = None
+        self._runner_task: Optional[asyncio.Task] = None
+        self._dispatches: Set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        if self._runner_task is None or self._runner_task.done():
+            self._queue = asyncio.Queue()
+            self._runner_task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10) -> None:
+        if self._runner_task is not None:
+            self._runner_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._runner_task
+            self._runner_task = None
+        if self._dispatches:
+            # Let in-flight batches finish before the shared HTTP client is closed
+            _, pending = await asyncio.wait(set(self._dispatches), timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        while self._queue is not None and not self._queue.empty():
+            _fail_pending([self._queue.get_nowait()], RuntimeError("Server is shutting down"))
+
+    async def submit(self, payload: FailureRequest) -> FailureAnalysis:
+        if self.window <= 0 or self.max_size <= 1:
+            return await analyze_one(payload)
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((payload, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(items) < self.max_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # Dispatch in the background so the next window starts collecting immediately
+            task = asyncio.create_task(self._dispatch(items))
+            self._dispatches.add(task)
+            task.add_done_callback(self._dispatches.discard)
+
+    async def _dispatch(self, items: List[Tuple[FailureRequest, asyncio.Future]]) -> None:
+        try:
+            if len(items) > 1 and await self._dispatch_batch(items):
+                return
+            await asyncio.gather(*(self._dispatch_one(payload, future) for payload, future in items))
+        except asyncio.CancelledError:
+            _fail_pending(items, RuntimeError("Server is shutting down"))
+            raise
+
+    async def _dispatch_batch(self, items: List[Tuple[FailureRequest, asyncio.Future]]) -> bool:
+        """Resolve every future from one combined call; False means retry the items one by one."""
+        try:
+            results = await analyze_many([payload for payload, _ in items])
+        except Exception as exc:
+            if _is_auth_error(exc) or _is_transient(exc):
+                # Every item would hit the same provider error on its own
+                _fail_pending(items, exc)
+                return True
+            # One bad item must not fail the unrelated requests batched with it
+            logger.warning("Batched call for {} failures failed ({}), retrying individually", len(items), exc)
+            return False
+        for (_, future), analysis in zip(items, results):
+            if not future.done():
+                future.set_result(analysis)
+        return True
+
+    async def _dispatch_one(self, payload: FailureRequest, future: asyncio.Future) -> None:
+        try:
+            analysis = await analyze_one(payload)
+        except Exception as exc:
+            _fail_pending([(payload, future)], exc)
+            return
+        if not future.done():
+            future.set_result(analysis)
+
+
+batcher = MicroBatcher(SETTINGS.micro_batch_window_ms, SETTINGS.micro_batch_max_size)
+
+
+def _demo_args(payload: FailureRequest) -> Tuple[str, int, int, int]:
+    # Only missing values get defaults; a reported 0 is shown back as 0
+    return (
+        payload.description,
+        5 if payload.effort_level is None else payload.effort_level,
+        0 if payload.preparation_hours is None else payload.preparation_hours,
+        5 if payload.confidence_before is None else payload.confidence_before,
+    )
+
+
+def demo_response_for(payload: FailureRequest) -> FailureAnalysis:
+    return generate_demo_response(*_demo_args(payload))
+
+
+def demo_json_for(payload: FailureRequest) -> bytes:
+    return generate_demo_json(*_demo_args(payload))
+
+
+async def run_analysis(payload: FailureRequest) -> FailureAnalysis:
+    if USE_DEMO:
+        logger.debug("Using demo mode - API key not set")
+        return demo_response_for(payload)
 
     try:
-        # pydantic-ai v1.x returns an AgentRunResult with validated `.data`
-        result = await agent.run(prompt)
-        logger.info("Analysis completed")
-        return result.data
+        return await _run_cached(payload, lambda: batcher.submit(payload))
     except ValidationError as ve:
-        logger.error(f"Validation error: {ve}")
+        logger.error("Validation error: {}", ve)
         raise HTTPException(status_code=500, detail=f"Agent validation failed: {str(ve)}")
-    except httpx.HTTPError as he:
-        logger.error(f"HTTP error calling model: {he}")
+    except (ModelHTTPError, APIConnectionError, APIStatusError, httpx.HTTPError) as he:
+        if _is_auth_error(he):
+            logger.warning("Provider rejected the API key, falling back to demo mode")
+            return demo_response_for(payload)
+        logger.error("HTTP error calling model: {}", he)
         raise HTTPException(status_code=502, detail=f"Model provider unavailable: {str(he)}")
     except Exception as exc:  # pragma: no cover
-        logger.exception(f"Unexpected error: {exc}")
-        error_msg = str(exc)
+        if _is_connection_error(exc):
+            logger.error("Could not reach model provider: {}", exc)
+            raise HTTPException(status_code=502, detail=f"Model provider unavailable: {exc}")
+        logger.exception("Unexpected error: {}", exc)
         # Fallback to demo mode on API errors
-        if "api_key" in error_msg.lower() or "authentication" in error_msg.lower() or "401" in error_msg:
+        if _is_auth_error(exc):
             logger.warning("API error detected, falling back to demo mode")
-            return generate_demo_response(
-                payload.description,
-                payload.effort_level or 5,
-                payload.preparation_hours or 0,
-                payload.confidence_before or 5
-            )
-        raise HTTPException(status_code=500, detail=f"Server error: {error_msg}")
+            return demo_response_for(payload)
+        raise HTTPException(status_code=500, detail=f"Server error: {exc}")
+
+
+# response_model=None: results are already validated FailureAnalysis instances, so
+# FastAPI's second validation pass is skipped; `responses` keeps the OpenAPI schema
+@app.post("/analyze", response_model=None, responses={200: {"model": FailureAnalysis}})
+@limiter.limit(SETTINGS.demo_rate_limit, exempt_when=lambda: not USE_DEMO)
+async def analyze_failure(request: Request, payload: FailureRequest):
+    if USE_DEMO:
+        logger.debug("Using demo mode - API key not set")
+        # Pre-serialized bytes skip response-model validation and JSON encoding
+        return Response(content=demo_json_for(payload), media_type="application/json")
+    analysis = await run_analysis(payload)
+    return ORJSONResponse(content=analysis.model_dump(mode="json"))
+
 
+_batch_semaphore = asyncio.Semaphore(SETTINGS.max_concurrency)
+
+
+async def _analyze_batch_item(payload: FailureRequest) -> FailureAnalysis:
+    async with _batch_semaphore:
+        return await run_analysis(payload)
+
+
+@app.post(
+    "/analyze_batch",
+    response_model=None,
+    responses={200: {"model": List[Union[FailureAnalysis, BatchItemError]]}},
+)
+@limiter.limit(SETTINGS.demo_rate_limit, exempt_when=lambda: not USE_DEMO)
+async def analyze_batch(request: Request, payloads: List[FailureRequest]):
+    if len(payloads) > SETTINGS.max_batch_items:
+        raise HTTPException(status_code=413, detail=f"Batch too large: at most {SETTINGS.max_batch_items} items")
+
+    results = await asyncio.gather(*(_analyze_batch_item(p) for p in payloads), return_exceptions=True)
+
+    # One failed item must not fail the whole batch
+    items: List[Union[FailureAnalysis, BatchItemError]] = []
+    for result in results:
+        if isinstance(result, HTTPException):
+            items.append(BatchItemError(error=str(result.detail), status_code=result.status_code))
+        elif isinstance(result, BaseException):
+            logger.error("Batch item failed: {}", result)
+            items.append(BatchItemError(error=f"Server error: {result}", status_code=500))
+        else:
+            items.append(result)
+    return ORJSONResponse(content=[item.model_dump(mode="json") for item in items])
+
+
+def _sse(data: bytes, event: Optional[str] = None) -> bytes:
+    prefix = f"event: {event}\n".encode() if event else b""
+    return prefix + b"data: " + data + b"\n\n"
+
+
+async def _stream_analysis(payload: FailureRequest) -> AsyncIterator[bytes]:
+    if USE_DEMO:
+        logger.debug("Using demo mode - API key not set")
+        yield _sse(demo_json_for(payload))
+        yield _sse(b"{}", event="done")
+        return
+
+    key = _cache_key(payload)
+    async with _cache_lock:
+        cached = _cache_lookup(key)
+    if cached is not None:
+        logger.debug("Response cache hit (exact)")
+        yield _sse(_ANALYSIS_ADAPTER.dump_json(cached))
+        yield _sse(b"{}", event="done")
+        return
+
+    try:
+        async with agent.run_stream(render_prompt(payload)) as run:
+            # Each event is the full analysis so far, with fields filled in as they arrive
+            async for partial in run.stream_output(debounce_by=0.1):
+                yield _sse(_ANALYSIS_ADAPTER.dump_json(partial))
+            analysis = await run.get_output()
+        log_prompt_cache_usage(run)
+    except Exception as exc:
+        # Same fallback as /analyze when the provider rejects the API key
+        if _is_auth_error(exc):
+            logger.warning("API error detected, falling back to demo mode")
+            yield _sse(demo_json_for(payload))
+            yield _sse(b"{}", event="done")
+            return
+        logger.exception("Streaming analysis failed: {}", exc)
+        yield _sse(orjson.dumps({"detail": f"Server error: {exc}"}), event="error")
+        return
+
+    await _cache_store(payload, key, analysis)
+    logger.opt(lazy=True).debug("Streamed analysis completed for {}", lambda: payload.description[:40])
+    yield _sse(b"{}", event="done")
+
+
+@app.post("/analyze_stream")
+@limiter.limit(SETTINGS.demo_rate_limit, exempt_when=lambda: not USE_DEMO)
+async def analyze_stream(request: Request, payload: FailureRequest):
+    return StreamingResponse(
+        _stream_analysis(payload),
+        media_type="text/event-stream",
+        # Keep proxies such as nginx from buffering the event stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,11 @@
+import os
+import sys
+from pathlib import Path
+
+# Configure a real-mode app before app.main is imported; the model is swapped
+# for pydantic-ai's TestModel in the tests, so no provider is ever contacted
+os.environ.setdefault("OPENROUTER_API_KEY", "sk-test")
+os.environ.setdefault("WARMUP_ON_STARTUP", "0")
+os.environ.setdefault("KEEPALIVE_INTERVAL_SECONDS", "0")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
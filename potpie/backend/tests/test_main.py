@@ -0,0 +1,42 @@
+from typing import List
+
+import pytest
+from fastapi.testclient import TestClient
+from pydantic_ai.models.test import TestModel
+
+from app import main
+
+PAYLOAD = {
+    "description": "I failed my certification exam after only re-reading my notes.",
+    "effort_level": 0,
+    "preparation_hours": 12,
+    "confidence_before": 8,
+}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "agent", main.build_agent(TestModel()))
+    monkeypatch.setattr(main, "batch_agent", main.build_agent(TestModel(), output_type=List[main.FailureAnalysis]))
+    main._response_cache.clear()
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+def test_analyze_returns_agent_output(client):
+    res = client.post("/analyze", json=PAYLOAD)
+
+    assert res.status_code == 200
+    main.FailureAnalysis.model_validate(res.json())
+
+
+def test_analyze_batch_returns_one_result_per_item(client):
+    payloads = [dict(PAYLOAD, preparation_hours=hours) for hours in (1, 2, 3)]
+
+    res = client.post("/analyze_batch", json=payloads)
+
+    assert res.status_code == 200
+    items = res.json()
+    assert len(items) == 3
+    for item in items:
+        main.FailureAnalysis.model_validate(item)